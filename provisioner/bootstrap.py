@@ -1,11 +1,9 @@
-import json
+import functools
 from dataclasses import dataclass, replace
 from functools import cached_property
 from pathlib import Path
 
-import typedload
-
-from provisioner.resources import ASSETS_DIR, run_command, rm_tree, load_step
+from provisioner.resources import ASSETS_DIR, LOADER, run_command, rm_tree, load_step
 
 __all__ = [
     "VenvConfig",
@@ -15,23 +13,29 @@ __all__ = [
 
 
 SSH_PROVISIONER_NAME = "ssh-provisioner"
+# Same output as `pip list --format freeze`, without paying pip's startup
+FREEZE_SCRIPT = (
+    "import importlib.metadata as m;"
+    "print(*(f\"{d.metadata['Name']}=={d.version}\" for d in m.distributions()),"
+    " sep='\\n')"
+)
 
 
 @dataclass(frozen=True)
 class VEnv:
     id: str
 
-    @property
+    @cached_property
     def path(self) -> Path:
         return ASSETS_DIR / self.id / "venv"
 
-    @property
-    def pip(self) -> Path:
-        return self.path / "bin" / "pip"
+    @cached_property
+    def pip(self) -> str:
+        return str(self.path / "bin" / "pip")
 
-    @property
-    def python(self) -> Path:
-        return self.path / "bin" / "python3"
+    @cached_property
+    def python(self) -> str:
+        return str(self.path / "bin" / "python3")
 
 
 @dataclass(frozen=True)
@@ -56,23 +60,22 @@ class VenvConfig:
         if pre:
             return pre_venv
         try:
-            await run_command([str(self.venv.python), "--version"])
+            await run_command([self.venv.python, "--version"])
             return replace(pre_venv, ready=True)
         except Exception as e:
             return pre_venv
 
 
+@functools.cache
 def load_venv_config(id: str) -> VenvConfig:
-    return typedload.load(load_step(id), VenvConfig)
+    return LOADER.load(load_step(id), VenvConfig)
 
 
-def pip_is_installed(package: str, packages: list[dict[str, str]]) -> bool:
-    return any(
-        map(
-            lambda p: p.get("name") == package,
-            packages,
-        )
-    )
+def pip_is_installed(package: str, packages: str) -> bool:
+    """
+    Check if package is listed in the `pip list --format freeze` like output.
+    """
+    return packages.startswith(f"{package}==") or f"\n{package}==" in packages
 
 
 @dataclass(frozen=True)
@@ -87,7 +90,7 @@ class BootstrapConfig:
     def venv(self) -> VEnv:
         return VEnv(id=self.venv_resource_id)
 
-    @property
+    @cached_property
     def whl_path(self) -> Path:
         return (
             ASSETS_DIR
@@ -99,7 +102,7 @@ class BootstrapConfig:
         if apply:
             await run_command(
                 [
-                    str(self.venv.pip),
+                    self.venv.pip,
                     "install",
                     "--require-virtualenv",
                     "-y",
@@ -111,7 +114,7 @@ class BootstrapConfig:
         if apply:
             await run_command(
                 [
-                    str(self.venv.pip),
+                    self.venv.pip,
                     "uninstall",
                     "--require-virtualenv",
                     "-y",
@@ -124,22 +127,15 @@ class BootstrapConfig:
         boostrap_config = load_pre_bootstrap_config(step_id)
         if pre:
             return boostrap_config
-        match await run_command(
-            [
-                str(self.venv.pip),
-                "list",
-                "--require-virtualenv",
-                "--format",
-                "json",
-            ]
-        ):
-            case _, out, _ if out is not None:
+        match await run_command([self.venv.python, "-c", FREEZE_SCRIPT]):
+            case _, _, out if out is not None:
                 return replace(
                     boostrap_config,
-                    installed=pip_is_installed(self.package_name, json.loads(out)),
+                    installed=pip_is_installed(self.package_name, out),
                 )
         return boostrap_config
 
 
+@functools.cache
 def load_pre_bootstrap_config(id: str) -> BootstrapConfig:
-    return typedload.load(load_step(id), BootstrapConfig)
+    return LOADER.load(load_step(id), BootstrapConfig)
@@ -1,12 +1,13 @@
 import argparse
 import asyncio.subprocess
-import json
+import sys
 from contextlib import asynccontextmanager
 from dataclasses import dataclass
 from typing import Protocol, AsyncIterator
 
-import typedload
+import orjson
 
+from provisioner.resources import DUMPER
 from provisioner.users import users_step
 
 __all__ = [
@@ -14,7 +15,6 @@ __all__ = [
 ]
 
 
-@dataclass
 class Step[R](Protocol):
     @property
     def __match_args__(self) -> tuple[str, ...]:
@@ -41,12 +41,10 @@ class Provisioner:
         await self.step.deprovision(apply=apply)
 
     async def refresh(self, step_id: str, pre: bool, apply: bool = True) -> None:
-        print(
-            json.dumps(
-                typedload.dump(
-                    await self.step.refresh(step_id=step_id, pre=pre, apply=apply)
-                ),
-            )
+        state = await self.step.refresh(step_id=step_id, pre=pre, apply=apply)
+        sys.stdout.flush()
+        sys.stdout.buffer.write(
+            orjson.dumps(DUMPER.dump(state), option=orjson.OPT_APPEND_NEWLINE)
         )
 
 
@@ -1,26 +1,44 @@
 import asyncio
 import base64
 import enum
-import json
+import functools
+import os
 import shutil
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Callable, Any
+from typing import Awaitable, Callable, Any, Iterable
+
+import orjson
+from typedload.dataloader import Loader
+from typedload.datadumper import Dumper
 
 __all__ = [
+    "DUMPER",
+    "LOADER",
+    "MAX_CONCURRENCY",
+    "gather_bounded",
     "load_step",
     "run_command",
     "rm_tree",
+    "write_file",
 ]
 
 
 ASSETS_DIR = Path("/tmp") / "provisioner"
+MAX_CONCURRENCY = 16
+
+# Shared typedload instances, so type handlers are resolved once per process.
+LOADER = Loader()
+DUMPER = Dumper()
 
 
-@dataclass
 class CommandError(Exception):
-    stdout: str | None
-    stderr: str | None
+    __slots__ = ("stdout", "stderr")
+
+    def __init__(self, stdout: str | None, stderr: str | None) -> None:
+        super().__init__(stderr)
+        self.stdout = stdout
+        self.stderr = stderr
 
 
 class ResourceStatus(enum.Enum):
@@ -30,48 +48,60 @@ class ResourceStatus(enum.Enum):
 
 
 class ResourceState:
+    __slots__ = ()
     status: ResourceStatus
 
 
-@dataclass
+@dataclass(slots=True)
 class ResourceMissing(ResourceState):
     status: ResourceStatus = ResourceStatus.MISSING
 
 
-@dataclass
+@dataclass(slots=True)
 class ResourcePresent(ResourceState):
     status: ResourceStatus = ResourceStatus.PRESENT
 
 
-@dataclass
+@dataclass(slots=True)
 class ResourceOutdated(ResourceState):
     fields: list[str]
     status: ResourceStatus = ResourceStatus.OUTDATED
 
 
-def load_step(id: str) -> tuple[Any]:
-    return (
-        json.loads(
-            base64.b64decode((ASSETS_DIR / id / "payload").read_bytes()).decode("utf-8")
-        )["data"],
-    )
+@functools.cache
+def load_step(id: str) -> Any:
+    payload = base64.b64decode((ASSETS_DIR / id / "payload").read_bytes())
+    return orjson.loads(payload)["data"]
 
 
 async def run_command(
     cmd: list[str],
-    err_f: Callable[[str], str] = lambda x: x,
-    out_f: Callable[[str], str] = lambda x: x,
+    err_f: Callable[[str], str] | None = None,
+    out_f: Callable[[str], str] | None = None,
+    capture_stdout: bool = True,
 ) -> tuple[int, str | None, str | None]:
+    """
+    Run cmd and return its exit code, stderr and stdout.
+
+    With `capture_stdout=False` stdout is discarded and returned as None, stderr
+    is always captured so failures can be reported.
+    """
     p = await asyncio.subprocess.create_subprocess_exec(
-        cmd[0], *cmd[1:], stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        cmd[0],
+        *cmd[1:],
+        stdout=asyncio.subprocess.PIPE
+        if capture_stdout
+        else asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
     )
+    out, err = await p.communicate()
     r = await p.wait()
-    stderr = (
-        err_f((await p.stderr.read()).decode("utf-8")) if p.stderr is not None else None
-    )
-    stdout = (
-        out_f((await p.stdout.read()).decode("utf-8")) if p.stdout is not None else None
-    )
+    stderr = err.decode("utf-8")
+    stdout = out.decode("utf-8") if out is not None else None
+    if err_f is not None:
+        stderr = err_f(stderr)
+    if out_f is not None and stdout is not None:
+        stdout = out_f(stdout)
 
     if r > 0:
         print(stderr)
@@ -84,5 +114,38 @@ async def run_command(
     return r, stderr, stdout
 
 
+async def gather_bounded[T](
+    aws: Iterable[Awaitable[T]], limit: int = MAX_CONCURRENCY
+) -> list[T]:
+    """
+    Await all the given awaitables concurrently, running at most `limit` at once.
+    Every awaitable runs to completion, the first error found is raised afterwards.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def _bounded(aw: Awaitable[T]) -> T:
+        async with semaphore:
+            return await aw
+
+    results = await asyncio.gather(*map(_bounded, aws), return_exceptions=True)
+    values: list[T] = []
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+        values.append(result)
+    return values
+
+
 def rm_tree(path: Path) -> None:
     shutil.rmtree(str(path), ignore_errors=True)
+
+
+def write_file(path: Path, content: bytes, mode: int = 0o644) -> None:
+    """
+    Write content to path with a single write, creating it with the given mode.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        os.write(fd, content)
+    finally:
+        os.close(fd)
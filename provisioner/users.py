@@ -1,23 +1,25 @@
+import asyncio
 import base64
 import functools
 import json
+import os
 import pwd
-from dataclasses import dataclass, field
+from dataclasses import dataclass
+from os import chown
 from pathlib import Path
-from shutil import chown
-from typing import Iterable
-
-import typedload
+from typing import Any, Awaitable, Callable, Iterable
 
 from provisioner.resources import (
-    ResourceStatus,
     ASSETS_DIR,
+    MAX_CONCURRENCY,
     ResourcePresent,
     ResourceOutdated,
     ResourceMissing,
     ResourceState,
+    gather_bounded,
     run_command,
     load_step,
+    write_file,
 )
 
 
@@ -36,7 +38,7 @@ __all__ = [
 SUDOERS_FILE = Path("/etc/sudoers.d") / "ssh-provisioner"
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class User:
     name: str
     home: Path | None = None
@@ -45,67 +47,66 @@ class User:
 
     @property
     def home_dir(self) -> Path:
-        return self.home or Path("/home/") / self.name
+        return self.home or Path("/home", self.name)
 
     async def write_authorized_keys(self) -> None:
         if self.key:
-            await write_authorized_keys(self.authorized_keys, self.key)
-            chown(self.authorized_keys, user=self.name, group=self.name)
+            authorized_keys = self.authorized_keys
+            await write_authorized_keys(authorized_keys, self.key)
+            uid, gid = user_ids(self.name)
+            chown(authorized_keys.parent, uid, gid)
+            chown(authorized_keys, uid, gid)
 
     async def delete(self) -> None:
-        await run_command(["/usr/sbin/userdel", "-r", self.name])
+        await run_command(["/usr/sbin/userdel", "-r", self.name], capture_stdout=False)
 
     async def create(self) -> None:
         await run_command(
             ["/usr/sbin/useradd", "-m", "-U"]
             + (["-G", "sudo"] if self.sudo else [])
-            + [self.name]
+            + [self.name],
+            capture_stdout=False,
         )
         await self.write_authorized_keys()
 
     @property
     def authorized_keys(self) -> Path:
-        return self.home_dir / ".ssh" / "authorized_keys"
+        return self.home_dir.joinpath(".ssh", "authorized_keys")
 
     @property
     def state(self) -> ResourceState:
-        match manageable_user_dict().get(self.name):
-            case None:
-                return ResourceMissing()
-            case User(
-                key=key,
-                sudo=sudo,
-            ) if key == self.key and sudo == self.sudo:
-                return ResourcePresent()
-            case User(key=key, sudo=sudo):
-                return ResourceOutdated(
-                    fields=list(
-                        filter(
-                            None,
-                            (
-                                "key" if key != self.key else None,
-                                "sudo" if self.sudo != sudo else None,
-                            ),
-                        )
-                    )
-                )
+        current = manageable_user_dict().get(self.name)
+        if current is None:
+            return ResourceMissing()
+        outdated = [
+            attr
+            for attr, changed in (
+                ("key", current.key != self.key),
+                ("sudo", current.sudo != self.sudo),
+            )
+            if changed
+        ]
+        if outdated:
+            return ResourceOutdated(fields=outdated)
+        return ResourcePresent()
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class UsersConfig:
-    ignore: frozenset[str] = field(default_factory=frozenset)
-    users: frozenset[User] = field(default_factory=frozenset)
+    ignore: frozenset[str] = frozenset()
+    users: frozenset[User] = frozenset()
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class UsersDiff:
-    users_final: frozenset[User] = field(default_factory=frozenset)
-    users_to_add: frozenset[User] = field(default_factory=frozenset)
-    users_to_delete: frozenset[User] = field(default_factory=frozenset)
-    users_to_update: frozenset[User] = field(default_factory=frozenset)
-    sudoers_final: frozenset[str] = field(default_factory=frozenset)
-    sudoers_to_add: frozenset[str] = field(default_factory=frozenset)
-    sudoers_to_delete: frozenset[str] = field(default_factory=frozenset)
+    users_final: frozenset[User] = frozenset()
+    users_to_add: frozenset[User] = frozenset()
+    users_to_delete: frozenset[User] = frozenset()
+    users_to_update: frozenset[User] = frozenset()
+    sudoers_final: frozenset[str] = frozenset()
+    sudoers_to_add: frozenset[str] = frozenset()
+    sudoers_to_delete: frozenset[str] = frozenset()
+    concurrency: int = MAX_CONCURRENCY
 
     async def provision(self, apply: bool) -> None:
         print(f"Users to add: {[u.name for u in self.users_to_add]}")
@@ -114,20 +115,14 @@ class UsersDiff:
         print(f"Sudoers to delete: {self.sudoers_to_delete}")
         print(f"Sudoers to add: {self.sudoers_to_delete}")
 
-        for user in self.users_to_delete:
-            print(f"Removing user {user.name}")
-            if apply:
-                await user.delete()
-
-        for user in self.users_to_add:
-            print(f"Adding user {user.name}")
-            if apply:
-                await user.create()
-
-        for user in self.users_to_update:
-            print(f"Modifying key user {user.name}")
-            if apply:
-                await user.write_authorized_keys()
+        await self._apply("Removing user", self.users_to_delete, User.delete, apply)
+        await self._apply("Adding user", self.users_to_add, User.create, apply)
+        await self._apply(
+            "Modifying key user",
+            self.users_to_update,
+            User.write_authorized_keys,
+            apply,
+        )
 
         if self.sudoers_final:
             print(f"Adding users to sudoers: {','.join(self.sudoers_final)}")
@@ -138,19 +133,33 @@ class UsersDiff:
             if apply:
                 SUDOERS_FILE.unlink()
 
-    async def deprovision(self, apply: bool = False) -> None:
-        for user in self.users_to_delete:
-            print(f"Removing user {user.name}")
-            if apply:
-                await user.delete()
-
+        if apply:
+            clear_system_users_cache()
 
-@dataclass(frozen=True)
+    async def deprovision(self, apply: bool = False) -> None:
+        await self._apply("Removing user", self.users_to_delete, User.delete, apply)
+        if apply:
+            clear_system_users_cache()
+
+    async def _apply(
+        self,
+        label: str,
+        users: frozenset[User],
+        action: Callable[[User], Awaitable[None]],
+        apply: bool,
+    ) -> None:
+        for user in users:
+            print(f"{label} {user.name}")
+        if apply:
+            await gather_bounded(map(action, users), self.concurrency)
+
+
+@dataclass(frozen=True, slots=True)
 class Users:
     id: str
-    users: frozenset[User] = field(default_factory=frozenset)
+    users: frozenset[User] = frozenset()
     name: str = "users"
-    ignore: frozenset[str] = field(default_factory=frozenset)
+    ignore: frozenset[str] = frozenset()
 
     async def provision(self, apply: bool = False) -> None:
         """
@@ -159,7 +168,7 @@ class Users:
         await self.state(
             Users(
                 self.id,
-                users=manageable_users(),
+                users=manageable_users(keys_for=frozenset(u.name for u in self.users)),
             )
         ).provision(apply=apply)
 
@@ -183,12 +192,7 @@ class Users:
         return Users(
             id=self.id,
             ignore=pre_users_config.ignore,
-            users=frozenset(
-                filter(
-                    lambda u: u.state.status == ResourceStatus.PRESENT,
-                    pre_users_config.users,
-                ),
-            ),
+            users=present_users(pre_users_config.users),
         )
 
     def state(self, current_state: "Users") -> UsersDiff:
@@ -197,42 +201,31 @@ class Users:
         """
         add_users = set()
         update_users = set()
-        existing_users = set()
-        all_users_dict = {s.name: s for s in current_state.users}
+        # Current users not claimed by any expected user end up being deleted
+        leftover_users = {s.name: s for s in current_state.users}
         for user in self.users:
-            match all_users_dict.get(user.name):
-                case User(
-                    key=key,
-                    home=home,
-                    sudo=sudo,
-                ) if user.key != key or user.home_dir != home or user.sudo != sudo:
-                    update_users.add(
-                        u_user := User(
-                            name=user.name,
-                            key=user.key,
-                            home=home or user.home_dir,
-                            sudo=user.sudo,
-                        )
+            current = leftover_users.pop(user.name, None)
+            if current is None:
+                add_users.add(user)
+            elif (
+                user.key != current.key
+                or user.home_dir != current.home
+                or user.sudo != current.sudo
+            ):
+                update_users.add(
+                    User(
+                        name=user.name,
+                        key=user.key,
+                        home=current.home or user.home_dir,
+                        sudo=user.sudo,
                     )
-                    all_users_dict[user.name] = u_user
-                case User() as user:
-                    existing_users.add(user)
-                case None:
-                    add_users.add(user)
-        expected_sudoers = frozenset(
-            map(lambda u: u.name, filter(lambda u: u.sudo, self.users))
-        )
+                )
+        expected_sudoers = frozenset(u.name for u in self.users if u.sudo)
         current_sudoers = users_in_sudoer_file()
         return UsersDiff(
             users_final=frozenset(self.users),
             users_to_delete=frozenset(
-                filter(
-                    lambda u: u.name not in self.ignore,
-                    (
-                        set(all_users_dict.values())
-                        - add_users.union(existing_users).union(update_users)
-                    ),
-                )
+                u for u in leftover_users.values() if u.name not in self.ignore
             ),
             users_to_add=frozenset(add_users),
             users_to_update=frozenset(update_users),
@@ -242,8 +235,9 @@ class Users:
         )
 
 
+@functools.cache
 def load_pre_users_config(id: str) -> UsersConfig:
-    return typedload.load(load_step(id), UsersConfig)
+    return dict_to_users_config(load_step(id))
 
 
 def load_users_config(
@@ -251,9 +245,24 @@ def load_users_config(
 ) -> UsersConfig:
     return UsersConfig(
         ignore=(pre := load_pre_users_config(id)).ignore,
-        users=frozenset(
-            filter(lambda u: u.state.status == ResourceStatus.PRESENT, pre.users),
-        ),
+        users=present_users(pre.users),
+    )
+
+
+def present_users(users: Iterable[User]) -> frozenset[User]:
+    """
+    Return the users already present in the system as described.
+
+    Same check as `User.state` being `ResourcePresent`, but fetching the system
+    users index once instead of once per user.
+    """
+    current_users = manageable_user_dict()
+    return frozenset(
+        u
+        for u in users
+        if (current := current_users.get(u.name)) is not None
+        and current.key == u.key
+        and current.sudo == u.sudo
     )
 
 
@@ -268,58 +277,96 @@ def users_step(id: str) -> Users:
 async def write_authorized_keys(authorized_keys: Path, key: str) -> None:
     print("Creating", authorized_keys.parent)
     authorized_keys.parent.mkdir(parents=True, exist_ok=True, mode=0o700)
-    with authorized_keys.open("w") as f:
-        f.write(base64.b64decode(key).decode("utf-8"))
+    await asyncio.to_thread(write_file, authorized_keys, base64.b64decode(key), 0o600)
 
 
 async def write_sudoers_content(users: Iterable[str]) -> None:
-    with SUDOERS_FILE.open("w") as f:
-        f.write(
-            "\n".join(list(map(lambda u: f"{u} ALL=(ALL:ALL) NOPASSWD:ALL", users)))
-            + "\n"
-        )
+    content = b"".join(f"{u} ALL=(ALL:ALL) NOPASSWD:ALL\n".encode() for u in users)
+    await asyncio.to_thread(write_file, SUDOERS_FILE, content, 0o440)
 
 
 def read_pub_key(p: Path) -> str | None:
+    # Open directly instead of checking is_file() first, saving a stat per user
     try:
-        if (ssh_pub_key := (p / ".ssh" / "authorized_keys")).is_file():
-            return base64.b64encode(ssh_pub_key.read_bytes()).decode("utf-8")
-        return None
-    except PermissionError:
+        with open(os.path.join(p, ".ssh", "authorized_keys"), "rb") as f:
+            return base64.b64encode(f.read()).decode("ascii")
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError, PermissionError):
         return None
 
 
+def user_ids(name: str) -> tuple[int, int]:
+    """
+    Return the uid and primary gid of the given user with a single lookup.
+    """
+    pw = pwd.getpwnam(name)
+    return pw.pw_uid, pw.pw_gid
+
+
 @functools.cache
 def users_in_sudoer_file() -> frozenset[str]:
     try:
-        with SUDOERS_FILE.open("r") as f:
-            return frozenset(map(lambda s: s.split(" ")[0], f.readlines()))
+        data = SUDOERS_FILE.read_bytes()
     except FileNotFoundError:
         return frozenset()
+    return frozenset(
+        line.partition(b" ")[0].decode("utf-8") for line in data.splitlines() if line
+    )
 
 
-def in_sudoer_file(user: str) -> bool:
-    return user in users_in_sudoer_file()
+def dict_to_user(d: dict[str, Any]) -> User:
+    return User(
+        name=d["name"],
+        home=Path(home) if (home := d.get("home")) is not None else None,
+        key=d.get("key"),
+        sudo=d.get("sudo", True),
+    )
 
 
-def pw_entry_to_user(pw: pwd.struct_passwd) -> User:
-    return User(
-        name=pw.pw_name,
-        home=Path(pw.pw_dir),
-        key=read_pub_key(Path(pw.pw_dir)),
-        sudo=in_sudoer_file(pw.pw_name),
+def dict_to_users_config(d: dict[str, Any]) -> UsersConfig:
+    """
+    Build a UsersConfig from its decoded payload, without going through typedload.
+    """
+    return UsersConfig(
+        ignore=frozenset(d.get("ignore", ())),
+        users=frozenset(map(dict_to_user, d.get("users", ()))),
     )
 
 
+def manageable_users(keys_for: frozenset[str] | None = None) -> frozenset[User]:
+    """
+    Return the users that can be managed by the provisioner.
+
+    When `keys_for` is given, authorized keys are only read for those users,
+    the rest are returned without key.
+    """
+    return frozenset(manageable_user_dict(keys_for).values())
+
+
 @functools.cache
-def manageable_users() -> frozenset[User]:
-    return frozenset(
-        map(
-            pw_entry_to_user, filter(lambda s: 1000 <= s.pw_uid <= 2000, pwd.getpwall())
+def manageable_user_dict(keys_for: frozenset[str] | None = None) -> dict[str, User]:
+    """
+    Return the manageable users indexed by name, see `manageable_users`.
+    """
+    sudoers = users_in_sudoer_file()
+    return {
+        pw.pw_name: User(
+            name=pw.pw_name,
+            home=(home := Path(pw.pw_dir)),
+            key=(
+                read_pub_key(home)
+                if keys_for is None or pw.pw_name in keys_for
+                else None
+            ),
+            sudo=pw.pw_name in sudoers,
         )
-    )
+        for pw in pwd.getpwall()
+        if 1000 <= pw.pw_uid <= 2000
+    }
 
 
-@functools.cache
-def manageable_user_dict() -> dict[str, User]:
-    return {u.name: u for u in manageable_users()}
+def clear_system_users_cache() -> None:
+    """
+    Forget the cached view of the system users, to be called after modifying them.
+    """
+    manageable_user_dict.cache_clear()
+    users_in_sudoer_file.cache_clear()
@@ -1,5 +1,4 @@
 import contextlib
-import itertools
 import shutil
 import tempfile
 from dataclasses import dataclass
@@ -24,7 +23,8 @@ class MockCommands:
     write_sudoers_content: MagicMock
     run_command: MagicMock
     chown: MagicMock
-    manageable_users: MagicMock
+    user_ids: MagicMock
+    manageable_user_dict: MagicMock
     users_in_sudoer_file: MagicMock
     load_pre_users_config: MagicMock
     load_pre_bootstrap_config: MagicMock
@@ -39,7 +39,8 @@ SIDE_EFFECT_MOCKS = [
     "provisioner.{}.write_sudoers_content",
     "provisioner.{}.users_in_sudoer_file",
     "provisioner.{}.chown",
-    "provisioner.{}.manageable_users",
+    "provisioner.{}.user_ids",
+    "provisioner.{}.manageable_user_dict",
     "provisioner.{}.load_pre_users_config",
     "provisioner.{}.read_pub_key",
     "provisioner.{}.rm_tree",
@@ -51,7 +52,8 @@ SIDE_EFFECT_MOCKS = [
 @contextlib.contextmanager
 def mock_commands(
     module: str,
-    run_commands: dict[str, tuple[int, str | None, str | None]] | None = None,
+    run_commands: dict[tuple[str, ...], tuple[int, str | None, str | None]]
+    | None = None,
     users_in_sudoer: frozenset[str] | None = None,
     manageable_users: frozenset[User] | None = None,
     pre_users_config: UsersConfig | None = None,
@@ -78,8 +80,9 @@ def mock_commands(
             cmd: list[str],
             err_f: Callable[[str], str] | None = None,
             out_f: Callable[[str], str] | None = None,
+            capture_stdout: bool = True,
         ) -> tuple[int, str | None, str | None]:
-            match (run_commands or {}).get(" ".join(cmd), None):
+            match (run_commands or {}).get(tuple(cmd), None):
                 case None:
                     return 1, None, None
                 case p, e, o:
@@ -89,9 +92,10 @@ def mock_commands(
         def _read_pub_key(p: Path) -> str:
             match (
                 next(
-                    itertools.dropwhile(
-                        lambda t: str(p).startswith(t[0]),
-                        (pub_keys or {}).items(),
+                    (
+                        key
+                        for prefix, key in (pub_keys or {}).items()
+                        if str(p).startswith(prefix)
                     ),
                     None,
                 ),
@@ -101,7 +105,7 @@ def mock_commands(
                     return f"{user}-some-key"
                 case None, [user]:
                     return f"{user}-some-key"
-                case (_, key), _:
+                case str() as key, _:
                     return key
             return "unknown"
 
@@ -111,10 +115,12 @@ def mock_commands(
             mock_command.users_in_sudoer_file.return_value = (
                 users_in_sudoer if users_in_sudoer else frozenset()
             )
-        if mock_command.manageable_users:
-            mock_command.manageable_users.return_value = (
-                manageable_users if manageable_users else frozenset()
-            )
+        if mock_command.user_ids:
+            mock_command.user_ids.return_value = (1000, 1000)
+        if mock_command.manageable_user_dict:
+            mock_command.manageable_user_dict.return_value = {
+                u.name: u for u in manageable_users or ()
+            }
         if mock_command.load_pre_users_config:
             mock_command.load_pre_users_config.return_value = (
                 pre_users_config if pre_users_config else UsersConfig()
@@ -130,12 +136,11 @@ def mock_commands(
 
         yield mock_command
     finally:
-        for p in patches.values():
-            p.stop()
+        patch.stopall()
         for f in reset_cache or []:
             f.cache_clear()
-        if mock_command.manageable_users:
-            mock_command.manageable_users.cache_clear()
+        if mock_command.manageable_user_dict:
+            mock_command.manageable_user_dict.cache_clear()
 
 
 @contextlib.contextmanager
@@ -1,4 +1,3 @@
-import json
 from functools import partial
 from pathlib import Path
 from unittest.mock import call, patch
@@ -7,6 +6,7 @@ from provisioner.bootstrap import (
     VenvConfig,
     load_venv_config,
     BootstrapConfig,
+    FREEZE_SCRIPT,
     pip_is_installed,
 )
 from provisioner.resources import run_command
@@ -17,15 +17,12 @@ bootstrap_mock_commands = partial(mock_commands, module="bootstrap")
 
 
 def test_pip_is_installed() -> None:
-    assert pip_is_installed("ssh-provisioner", []) is False
+    assert pip_is_installed("ssh-provisioner", "") is False
 
     assert (
         pip_is_installed(
             "ssh-provisioner",
-            [
-                {"name": "package-a", "version": "6.6.6"},
-                {"name": "package-b", "version": "6.6.6"},
-            ],
+            "package-a==6.6.6\npackage-b==6.6.6\n",
         )
         is False
     )
@@ -33,11 +30,7 @@ def test_pip_is_installed() -> None:
     assert (
         pip_is_installed(
             "ssh-provisioner",
-            [
-                {"name": "ssh-provisioner", "version": "6.6.6"},
-                {"name": "package-a", "version": "6.6.6"},
-                {"name": "package-b", "version": "6.6.6"},
-            ],
+            "ssh-provisioner==6.6.6\npackage-a==6.6.6\npackage-b==6.6.6\n",
         )
         is True
     )
@@ -45,11 +38,7 @@ def test_pip_is_installed() -> None:
     assert (
         pip_is_installed(
             "ssh-provisioner",
-            [
-                {"name": "package-a", "version": "6.6.6"},
-                {"name": "package-b", "version": "6.6.6"},
-                {"name": "ssh-provisioner", "version": "6.6.6"},
-            ],
+            "package-a==6.6.6\npackage-b==6.6.6\nssh-provisioner==6.6.6\n",
         )
         is True
     )
@@ -57,15 +46,19 @@ def test_pip_is_installed() -> None:
     assert (
         pip_is_installed(
             "ssh-provisioner",
-            [
-                {"name": "package-a", "version": "6.6.6"},
-                {"name": "ssh-provisioner", "version": "6.6.6"},
-                {"name": "package-b", "version": "6.6.6"},
-            ],
+            "package-a==6.6.6\nssh-provisioner==6.6.6\npackage-b==6.6.6\n",
         )
         is True
     )
 
+    assert (
+        pip_is_installed(
+            "ssh-provisioner",
+            "new-ssh-provisioner==6.6.6\nssh-provisioner-extra==6.6.6\n",
+        )
+        is False
+    )
+
 
 async def test_venv_config_provision_0() -> None:
     with bootstrap_mock_commands() as cmd:
@@ -289,13 +282,14 @@ async def test_bootstrap_config_refresh_1() -> None:
             installed=False,
         ),
         run_commands={
-            "/tmp/provisioner/test-resource-1/venv/bin/pip list "
-            + "--require-virtualenv "
-            + "--format "
-            + "json": (
+            (
+                "/tmp/provisioner/test-resource-1/venv/bin/python3",
+                "-c",
+                FREEZE_SCRIPT,
+            ): (
                 0,
-                json.dumps([{"name": "ssh-provisioner", "version": "6.6.6"}]),
                 None,
+                "ssh-provisioner==6.6.6\n",
             )
         },
     ) as cmd:
@@ -0,0 +1,38 @@
+import base64
+import json
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+from provisioner.resources import CommandError, load_step, run_command
+
+
+def test_load_step_0(tmp_path: Path) -> None:
+    (tmp_path / "test-resource").mkdir()
+    (tmp_path / "test-resource" / "payload").write_bytes(
+        base64.b64encode(json.dumps({"data": {"id": "test-resource"}}).encode())
+    )
+    with patch("provisioner.resources.ASSETS_DIR", tmp_path):
+        try:
+            assert load_step("test-resource") == {"id": "test-resource"}
+        finally:
+            load_step.cache_clear()
+
+
+async def test_run_command_0() -> None:
+    assert await run_command(["/bin/sh", "-c", "echo out; echo err >&2"]) == (
+        0,
+        "err\n",
+        "out\n",
+    )
+    assert await run_command(
+        ["/bin/sh", "-c", "echo out; echo err >&2"], capture_stdout=False
+    ) == (0, "err\n", None)
+
+
+async def test_run_command_1() -> None:
+    with pytest.raises(CommandError) as e:
+        await run_command(["/bin/sh", "-c", "echo out; echo err >&2; exit 3"])
+    assert e.value.stderr == "err\n"
+    assert e.value.stdout == "out\n"
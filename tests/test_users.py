@@ -1,17 +1,27 @@
-from functools import partial
+import asyncio
+import base64
+import pwd
+from functools import cache, partial
 from pathlib import Path
 
-from unittest.mock import call
+from unittest.mock import call, patch
 
 from provisioner.users import (
     Users,
+    dict_to_users_config,
     User,
     load_users_config,
     UsersConfig,
     UsersDiff,
     manageable_user_dict,
+    manageable_users,
+    read_pub_key,
+    users_in_sudoer_file,
+    write_authorized_keys,
+    write_sudoers_content,
 )
 from provisioner.resources import (
+    LOADER,
     ResourceMissing,
     ResourceOutdated,
     ResourcePresent,
@@ -22,6 +32,7 @@ from tests.common import mock_commands
 TEST_USER_ID = "5a97ea12-28e8-4fa4-830f-a5573cbf360b"
 
 
+@cache
 def generate_test_user(
     name: str,
     home: Path | None = None,
@@ -264,13 +275,18 @@ async def test_users_provision_0():
             ),
         ).provision(apply=True)
         assert commands.run_command.call_args_list == [
-            call(["/usr/sbin/useradd", "-m", "-U", "-G", "sudo", "user1"])
+            call(
+                ["/usr/sbin/useradd", "-m", "-U", "-G", "sudo", "user1"],
+                capture_stdout=False,
+            )
         ]
         assert commands.write_authorized_keys.call_args_list == [
             call(Path("/home/user1/.ssh/authorized_keys"), "user1-some-key")
         ]
+        assert commands.user_ids.call_args_list == [call("user1")]
         assert commands.chown.call_args_list == [
-            call(Path("/home/user1/.ssh/authorized_keys"), user="user1", group="user1")
+            call(Path("/home/user1/.ssh"), 1000, 1000),
+            call(Path("/home/user1/.ssh/authorized_keys"), 1000, 1000),
         ]
 
 
@@ -305,8 +321,11 @@ async def test_users_provision_2():
             ),
         ).provision(apply=True)
         assert commands.run_command.call_args_list == [
-            call(["/usr/sbin/userdel", "-r", "user2"]),
-            call(["/usr/sbin/useradd", "-m", "-U", "-G", "sudo", "user1"]),
+            call(["/usr/sbin/userdel", "-r", "user2"], capture_stdout=False),
+            call(
+                ["/usr/sbin/useradd", "-m", "-U", "-G", "sudo", "user1"],
+                capture_stdout=False,
+            ),
         ]
         assert commands.write_authorized_keys.call_args_list == [
             call(Path("/home/user1/.ssh/authorized_keys"), "user1-some-key")
@@ -353,7 +372,60 @@ async def test_users_provision_4():
         ]
 
 
-async def test_load_users_config_0() -> None:
+async def test_users_provision_5():
+    with user_mock_commands(
+        manageable_users=frozenset(
+            {generate_test_user("user3"), generate_test_user("user4")}
+        ),
+        users_in_sudoer=frozenset(),
+    ) as commands:
+        await Users(
+            id=TEST_USER_ID,
+            users=frozenset(
+                {
+                    generate_test_user("user1"),
+                    generate_test_user("user2", sudo=False),
+                }
+            ),
+        ).provision(apply=True)
+        assert sorted(commands.run_command.call_args_list[:2]) == [
+            call(["/usr/sbin/userdel", "-r", "user3"], capture_stdout=False),
+            call(["/usr/sbin/userdel", "-r", "user4"], capture_stdout=False),
+        ]
+        assert sorted(commands.run_command.call_args_list[2:]) == [
+            call(
+                ["/usr/sbin/useradd", "-m", "-U", "-G", "sudo", "user1"],
+                capture_stdout=False,
+            ),
+            call(["/usr/sbin/useradd", "-m", "-U", "user2"], capture_stdout=False),
+        ]
+
+
+async def test_users_diff_deprovision_0():
+    running, peak = 0, 0
+
+    async def _run_command(cmd: list[str], capture_stdout: bool = True) -> None:
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0)
+        running -= 1
+
+    with user_mock_commands() as commands:
+        commands.run_command.side_effect = _run_command
+        await UsersDiff(
+            users_to_delete=frozenset(
+                generate_test_user(f"user{i}") for i in range(1, 6)
+            ),
+            concurrency=2,
+        ).deprovision(apply=True)
+        assert commands.run_command.call_count == 5
+        assert peak == 2
+        commands.manageable_user_dict.cache_clear.assert_called_once()
+        commands.users_in_sudoer_file.cache_clear.assert_called_once()
+
+
+def test_load_users_config_0() -> None:
     with user_mock_commands(
         pre_users_config=(
             uc := UsersConfig(
@@ -370,7 +442,7 @@ async def test_load_users_config_0() -> None:
         assert load_users_config(id=TEST_USER_ID) == UsersConfig()
 
 
-async def test_load_users_config_1() -> None:
+def test_load_users_config_1() -> None:
     with user_mock_commands(
         pre_users_config=(
             uc := UsersConfig(
@@ -396,7 +468,7 @@ async def test_load_users_config_1() -> None:
         ) == UsersConfig(users=uc.users)
 
 
-async def test_load_users_config_2() -> None:
+def test_load_users_config_2() -> None:
     with user_mock_commands(
         pre_users_config=(
             uc := UsersConfig(
@@ -427,7 +499,7 @@ async def test_load_users_config_2() -> None:
         )
 
 
-async def test_load_users_config_3() -> None:
+def test_load_users_config_3() -> None:
     with user_mock_commands(
         pre_users_config=(
             uc := UsersConfig(
@@ -485,3 +557,91 @@ def test_user_state_3() -> None:
         assert generate_test_user("user1").state == ResourceOutdated(
             fields=["key", "sudo"],
         )
+
+
+async def test_write_authorized_keys_0(tmp_path: Path) -> None:
+    authorized_keys = tmp_path / ".ssh" / "authorized_keys"
+    await write_authorized_keys(
+        authorized_keys, base64.b64encode(b"ssh-ed25519 AAAA user1\n").decode()
+    )
+    assert authorized_keys.read_bytes() == b"ssh-ed25519 AAAA user1\n"
+    assert authorized_keys.stat().st_mode & 0o777 == 0o600
+    assert authorized_keys.parent.stat().st_mode & 0o777 == 0o700
+
+
+def test_manageable_users_0() -> None:
+    pw_entries = [
+        pwd.struct_passwd((name, "x", uid, uid, "", f"/home/{name}", "/bin/sh"))
+        for name, uid in (("root", 0), ("user1", 1000), ("user2", 1001))
+    ]
+    with (
+        patch("provisioner.users.pwd.getpwall", return_value=pw_entries),
+        patch("provisioner.users.read_pub_key", return_value="some-key") as read_key,
+        patch("provisioner.users.users_in_sudoer_file", return_value=frozenset()),
+    ):
+        try:
+            assert manageable_users(keys_for=frozenset({"user1"})) == frozenset(
+                {
+                    User("user1", Path("/home/user1"), "some-key", sudo=False),
+                    User("user2", Path("/home/user2"), None, sudo=False),
+                }
+            )
+            assert read_key.call_args_list == [call(Path("/home/user1"))]
+        finally:
+            manageable_user_dict.cache_clear()
+
+
+def test_read_pub_key_0(tmp_path: Path) -> None:
+    assert read_pub_key(tmp_path) is None
+    (tmp_path / ".ssh" / "authorized_keys").mkdir(parents=True)
+    assert read_pub_key(tmp_path) is None
+    (tmp_path / ".ssh" / "authorized_keys").rmdir()
+    (tmp_path / ".ssh" / "authorized_keys").write_bytes(b"ssh-ed25519 AAAA user1\n")
+    assert (
+        read_pub_key(tmp_path) == base64.b64encode(b"ssh-ed25519 AAAA user1\n").decode()
+    )
+
+
+async def test_write_sudoers_content_0(tmp_path: Path) -> None:
+    sudoers_file = tmp_path / "ssh-provisioner"
+    with patch("provisioner.users.SUDOERS_FILE", sudoers_file):
+        await write_sudoers_content(["user1", "user2"])
+    assert sudoers_file.read_text() == (
+        "user1 ALL=(ALL:ALL) NOPASSWD:ALL\nuser2 ALL=(ALL:ALL) NOPASSWD:ALL\n"
+    )
+    assert sudoers_file.stat().st_mode & 0o777 == 0o440
+
+
+def test_dict_to_users_config_0() -> None:
+    data = {
+        "ignore": ["user3"],
+        "users": [
+            {"name": "user1", "home": "/root", "key": "user1-some-key"},
+            {"name": "user2", "key": None, "sudo": False},
+        ],
+    }
+    assert dict_to_users_config(data) == UsersConfig(
+        ignore=frozenset({"user3"}),
+        users=frozenset(
+            {
+                User("user1", Path("/root"), "user1-some-key"),
+                User("user2", sudo=False),
+            }
+        ),
+    )
+    assert dict_to_users_config(data) == LOADER.load(data, UsersConfig)
+    assert dict_to_users_config({}) == UsersConfig()
+
+
+def test_users_in_sudoer_file_0(tmp_path: Path) -> None:
+    sudoers_file = tmp_path / "ssh-provisioner"
+    with patch("provisioner.users.SUDOERS_FILE", sudoers_file):
+        try:
+            assert users_in_sudoer_file() == frozenset()
+            users_in_sudoer_file.cache_clear()
+            sudoers_file.write_text(
+                "user1 ALL=(ALL:ALL) NOPASSWD:ALL\n\nuser2 ALL=(ALL:ALL) NOPASSWD:ALL\n"
+            )
+            assert users_in_sudoer_file() == frozenset({"user1", "user2"})
+        finally:
+            users_in_sudoer_file.cache_clear()